@@ -12,6 +12,7 @@ DEFAULT_BATCH_COUNT = 20
 DEFAULT_EPOCH_COUNT = 40
 # GPU
 GPU_MEMORY_LIMIT_MB = 4096
+IS_XLA_JIT_ENABLED = False  # Opt-in: models are rebuilt for every partner and minibatch, each graph is recompiled
 
 # Logging
 INFO_LOGGING_FILE_NAME = "info.log"
@@ -3,36 +3,59 @@
 The dataset object used in the multi-partner learning and contributivity measurement experiments.
 """
 import glob
+import hashlib
+import inspect
 import shutil
 import zipfile
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
 from time import sleep
 from urllib.error import HTTPError, URLError
-from urllib.request import urlretrieve
+from urllib.request import urlopen
 
 import numpy as np
 import pandas as pd
-from joblib import dump, load
+from joblib import Memory, Parallel, delayed, dump, load
 from keras.datasets import cifar10, mnist, imdb
 from keras.layers import Activation
 from keras.layers import Conv2D, GlobalAveragePooling2D, MaxPooling2D
 from keras.layers import Dense, Dropout
 from keras.layers import Embedding, Conv1D, MaxPooling1D, Flatten
+from keras.layers import Lambda
 from keras.losses import categorical_crossentropy
 from keras.models import Sequential
 from keras.optimizers import RMSprop
 from keras.preprocessing import sequence
 from keras.utils import to_categorical
 from librosa import load as wav_load
+from librosa import power_to_db, stft
 from librosa.feature import mfcc
+from librosa.filters import mel
 from loguru import logger
 from sklearn.linear_model import LogisticRegression as skLR
 from sklearn.metrics import log_loss
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import ShuffleSplit, train_test_split
+from sklearn.preprocessing import OneHotEncoder
 
 from . import constants
 
+# Pre-processed datasets are memoized on disk, next to the raw downloaded data, and memory-mapped when reloaded.
+# Each dataset class has its own sub-folder, which only keeps the entry matching the current source of the class.
+# Deleting this folder clears the cache, the datasets are then pre-processed again at their next loading
+CACHE_FOLDER = Path(__file__).resolve().parents[0] / 'local_data' / 'cache'
+
+
+def _load_data(dataset):
+    """
+    Return the output of dataset.load_data(). The dataset object itself is not hashed: the cache folder is keyed on the
+    dataset class name and on its source code, so that any change in the loading or pre-processing invalidates it.
+    The arrays are stored uncompressed, so that they are memory-mapped when reloaded: for ESC-50, this skips the
+    audio decoding and the MFCC computation, and only the pages actually used are read from disk.
+    """
+    return dataset.load_data()
+
 
 class Dataset(ABC):
 
@@ -43,7 +66,8 @@ class Dataset(ABC):
                  x_train,
                  y_train,
                  x_test,
-                 y_test
+                 y_test,
+                 auto_val_split=True
                  ):
         self.name = dataset_name
 
@@ -57,16 +81,20 @@ class Dataset(ABC):
         self.y_val = None
         self.y_test = y_test
 
-        self.train_val_split_global()
+        # Datasets which can build their validation set more cheaply opt out, and set x_val and y_val themselves
+        if auto_val_split:
+            self.train_val_split_global()
 
     def train_val_split_global(self):
         """Called once, at the end of Dataset's constructor"""
-        if self.x_val or self.y_val:
+        if self.x_val is not None or self.y_val is not None:
             raise Exception("x_val and y_val should be of NoneType")
-        self.x_train, self.x_val, self.y_train, self.y_val = train_test_split(self.x_train,
-                                                                              self.y_train,
-                                                                              test_size=0.1,
-                                                                              random_state=42)
+        train_idx, val_idx = next(ShuffleSplit(n_splits=1, test_size=0.1, random_state=42).split(self.x_train))
+        # Sorted indices make the gathers below read the arrays in ascending order
+        train_idx.sort()
+        val_idx.sort()
+        self.x_val, self.y_val = self.x_train[val_idx], self.y_train[val_idx]
+        self.x_train, self.y_train = self.x_train[train_idx], self.y_train[train_idx]
 
     @staticmethod
     def train_test_split_local(x, y):
@@ -76,6 +104,23 @@ class Dataset(ABC):
     def train_val_split_local(x, y):
         return x, np.array([]), y, np.array([])
 
+    def load_cached_data(self):
+        """Return the output of self.load_data(), computed once and then reloaded from the disk cache"""
+        # The model definition doesn't affect the data, so changing it must not invalidate the cache
+        dataset_source = inspect.getsource(self.__class__).replace(inspect.getsource(self.generate_new_model), '')
+        source_hash = hashlib.sha1(dataset_source.encode()).hexdigest()
+        dataset_cache_folder = CACHE_FOLDER / self.__class__.__name__
+
+        # The entries written by previous versions of the class are stale, they are removed to bound the cache size
+        if dataset_cache_folder.is_dir():
+            for folder in dataset_cache_folder.iterdir():
+                if folder.name != source_hash:
+                    logger.debug(f"Removing stale cache entry {folder}")
+                    shutil.rmtree(folder, ignore_errors=True)
+
+        memory = Memory(location=dataset_cache_folder / source_hash, mmap_mode='r', verbose=0)
+        return memory.cache(_load_data, ignore=['dataset'])(self)
+
     @abstractmethod
     def generate_new_model(self):
         pass
@@ -91,26 +136,24 @@ class Dataset(ABC):
             logger.info(f"We don't use the full dataset: only {dataset_proportion * 100}%")
 
             skip_train_idx = int(round(len(self.x_train) * dataset_proportion))
-            train_idx = np.arange(len(self.x_train))
-
             skip_val_idx = int(round(len(self.x_val) * dataset_proportion))
-            val_idx = np.arange(len(self.x_val))
 
-            np.random.seed(42)
-            np.random.shuffle(train_idx)
-            np.random.shuffle(val_idx)
+            # Draw only the kept indices, sorted so that the gathers below read the arrays in ascending order
+            rng = np.random.default_rng(42)
+            train_idx = np.sort(rng.choice(len(self.x_train), skip_train_idx, replace=False))
+            val_idx = np.sort(rng.choice(len(self.x_val), skip_val_idx, replace=False))
 
-            self.x_train = self.x_train[train_idx[0:skip_train_idx]]
-            self.y_train = self.y_train[train_idx[0:skip_train_idx]]
-            self.x_val = self.x_val[val_idx[0:skip_val_idx]]
-            self.y_val = self.y_val[val_idx[0:skip_val_idx]]
+            self.x_train = self.x_train[train_idx]
+            self.y_train = self.y_train[train_idx]
+            self.x_val = self.x_val[val_idx]
+            self.y_val = self.y_val[val_idx]
 
 
 class Cifar10(Dataset):
     def __init__(self):
         self.input_shape = (32, 32, 3)
         self.num_classes = 10
-        x_test, x_train, y_test, y_train = self.load_data()
+        x_test, x_train, y_test, y_train = self.load_cached_data()
 
         super(Cifar10, self).__init__(dataset_name='cifar10',
                                       num_classes=self.num_classes,
@@ -152,9 +195,7 @@ class Cifar10(Dataset):
     # Data samples pre-processing method for inputs
     @staticmethod
     def preprocess_dataset_inputs(x):
-        x = x.astype("float32")
-        x /= 255
-
+        # Images are kept as uint8, the scaling to [0, 1] is done by the first layer of the model
         return x
 
     # Data samples pre-processing method for labels
@@ -168,7 +209,8 @@ class Cifar10(Dataset):
         """Return a CNN model from scratch based on given batch_size"""
 
         model = Sequential()
-        model.add(Conv2D(32, (3, 3), padding='same', input_shape=self.input_shape))
+        model.add(Lambda(lambda x: x / 255, input_shape=self.input_shape))
+        model.add(Conv2D(32, (3, 3), padding='same'))
         model.add(Activation('relu'))
         model.add(Conv2D(32, (3, 3)))
         model.add(Activation('relu'))
@@ -214,7 +256,7 @@ class Titanic(Dataset):
         self.num_classes = 2
         self.input_shape = (27,)
         # Load data
-        (x_train, y_train), (x_test, y_test) = self.load_data()
+        (x_train, y_train), (x_test, y_test) = self.load_cached_data()
 
         super(Titanic, self).__init__(dataset_name='titanic',
                                       num_classes=self.num_classes,
@@ -222,9 +264,16 @@ class Titanic(Dataset):
                                       x_train=x_train,
                                       y_train=y_train,
                                       x_test=x_test,
-                                      y_test=y_test
+                                      y_test=y_test,
+                                      auto_val_split=False
                                       )
 
+        # The samples are already shuffled by train_test_split_global, so the validation set is
+        # taken as a view on the tail of the train set, instead of a copy
+        val_count = int(np.ceil(len(self.x_train) * 0.1))
+        self.x_train, self.x_val = self.x_train[:-val_count], self.x_train[-val_count:]
+        self.y_train, self.y_val = self.y_train[:-val_count], self.y_train[-val_count:]
+
     # Init dataset-specific functions
     @staticmethod
     def preprocess_dataset_labels(y):
@@ -238,24 +287,20 @@ class Titanic(Dataset):
 
         x['Fam_size'] = x['Siblings/Spouses Aboard'] + x['Parents/Children Aboard']
 
-        x['Name_Len'] = [len(i) for i in x["Name"]]
+        x['Name_Len'] = x["Name"].str.len()
 
-        x['Is_alone'] = [i == 0 for i in x["Fam_size"]]
+        x['Is_alone'] = x["Fam_size"] == 0
 
-        x["Sex"] = [i == "Male" for i in x["Sex"]]
+        x["Sex"] = x["Sex"] == "Male"
 
-        x['Title'] = [i.split()[0] for i in x["Name"]]
-        x = pd.concat([x, pd.get_dummies(x['Title'])], axis=1)
+        x['Title'] = x["Name"].str.split(n=1, expand=True)[0]
 
-        x = pd.concat([x, pd.get_dummies(x['Pclass'])], axis=1)
+        # One-hot encode the titles and classes in a single pass
+        dummies = OneHotEncoder(dtype=np.float32).fit_transform(x[['Title', 'Pclass']]).toarray()
 
         # Dropping the useless features
-        x.drop('Name', axis=1, inplace=True)
-        x.drop('Pclass', axis=1, inplace=True)
-        x.drop('Siblings/Spouses Aboard', axis=1, inplace=True)
-        x.drop('Parents/Children Aboard', axis=1, inplace=True)
-        x.drop('Title', axis=1, inplace=True)
-        return x.to_numpy(dtype='float32')
+        x = x.drop(['Name', 'Pclass', 'Siblings/Spouses Aboard', 'Parents/Children Aboard', 'Title'], axis=1)
+        return np.hstack((x.to_numpy(dtype='float32'), dummies))
 
     def load_data(self):
         """Return a usable dataset"""
@@ -322,7 +367,7 @@ class Titanic(Dataset):
 
     class LogisticRegression(skLR):
         def __init__(self):
-            super(Titanic.LogisticRegression, self).__init__(max_iter=10000, warm_start=1, random_state=0)
+            super(Titanic.LogisticRegression, self).__init__(max_iter=10000, warm_start=True, random_state=0)
             self.coef_ = None
             self.intercept_ = None
 
@@ -344,8 +389,10 @@ class Titanic(Dataset):
             if self.coef_ is None:
                 model_evaluation = [0] * 2
             else:
-                loss = log_loss(y_eval, self.predict(x_eval))  # mimic keras model evaluation
-                accuracy = self.score(x_eval, y_eval)
+                # Both metrics are computed from a single forward pass
+                proba = self.predict_proba(x_eval)
+                loss = log_loss(y_eval, proba)  # mimic keras model evaluation
+                accuracy = np.mean(self.classes_[proba.argmax(axis=1)] == y_eval)
                 model_evaluation = [loss, accuracy]
 
             return model_evaluation
@@ -355,14 +402,14 @@ class Titanic(Dataset):
                 raise ValueError(
                     'Coef and intercept are set to None, it seems the model has not been fit properly.')
             if '.h5' in path:
-                logger.debug('Automatically switch file format from .h5 to .npy')
-                path.replace('.h5', '.npy')
-            np.save(path, self.get_weights())
+                logger.debug('Automatically switch file format from .h5 to .joblib')
+                path = path.replace('.h5', '.joblib')
+            dump(self.get_weights(), path, compress=3)
 
         def load_weights(self, path):
             if '.h5' in path:
-                logger.debug('Automatically switch file format from .h5 to .npy')
-                path.replace('.h5', '.npy')
+                logger.debug('Automatically switch file format from .h5 to .joblib')
+                path = path.replace('.h5', '.joblib')
             weights = load(path)
             self.set_weights(weights)
 
@@ -383,14 +430,14 @@ class Titanic(Dataset):
         def save_model(self, path):
             if '.h5' in path:
                 logger.debug('Automatically switch file format from .h5 to .joblib')
-                path.replace('.h5', '.joblib')
+                path = path.replace('.h5', '.joblib')
             dump(self, path)
 
         @staticmethod
         def load_model(path):
             if '.h5' in path:
                 logger.debug('Automatically switch file format from .h5 to .joblib')
-                path.replace('.h5', '.joblib')
+                path = path.replace('.h5', '.joblib')
             return load(path)
 
 
@@ -401,7 +448,7 @@ class Mnist(Dataset):
         self.img_cols = 28
         self.input_shape = (self.img_rows, self.img_cols, 1)
         self.num_classes = 10
-        x_test, x_train, y_test, y_train = self.load_data()
+        x_test, x_train, y_test, y_train = self.load_cached_data()
 
         super(Mnist, self).__init__(dataset_name='mnist',
                                     num_classes=self.num_classes,
@@ -441,9 +488,8 @@ class Mnist(Dataset):
 
     # Data samples pre-processing method for inputs
     def preprocess_dataset_inputs(self, x):
+        # Images are kept as uint8, the scaling to [0, 1] is done by the first layer of the model
         x = x.reshape(x.shape[0], self.img_rows, self.img_cols, 1)
-        x = x.astype("float32")
-        x /= 255
 
         return x
 
@@ -458,11 +504,11 @@ class Mnist(Dataset):
         """Return a CNN model from scratch based on given batch_size"""
 
         model = Sequential()
+        model.add(Lambda(lambda x: x / 255, input_shape=self.input_shape))
         model.add(Conv2D(
             32,
             kernel_size=(3, 3),
             activation="relu",
-            input_shape=self.input_shape,
         ))
         model.add(Conv2D(64, (3, 3), activation="relu"))
         model.add(MaxPooling2D(pool_size=(2, 2)))
@@ -493,7 +539,7 @@ class Imdb(Dataset):
         self.num_words = 5000
         self.num_classes = 2
         self.input_shape = (500,)
-        x_test, x_train, y_test, y_train = self.load_data()
+        x_test, x_train, y_test, y_train = self.load_cached_data()
 
         super(Imdb, self).__init__(dataset_name='imdb',
                                    num_classes=self.num_classes,
@@ -523,9 +569,12 @@ class Imdb(Dataset):
                     attempts += 1
                 else:
                     raise
-        x_train, x_test, y_train, y_test = train_test_split(np.concatenate((x_train, x_test), axis=0),
-                                                            np.concatenate((y_train, y_test), axis=0),
-                                                            test_size=0.2)
+        # Re-split the reviews by shuffling their indices, without building a concatenated array of sequences
+        x = list(x_train) + list(x_test)
+        y = np.concatenate((y_train, y_test))
+        train_idx, test_idx = train_test_split(np.arange(len(x)), test_size=0.2, random_state=42)
+        x_train, y_train = [x[i] for i in train_idx], y[train_idx]
+        x_test, y_test = [x[i] for i in test_idx], y[test_idx]
         # Pre-process inputs
         x_train = self.preprocess_dataset_inputs(x_train)
         x_test = self.preprocess_dataset_inputs(x_test)
@@ -539,7 +588,8 @@ class Imdb(Dataset):
         return y
 
     def preprocess_dataset_inputs(self, x):
-        x = sequence.pad_sequences(x, maxlen=self.input_shape[0])
+        # Word indexes are lower than num_words, so they fit in int16: this halves the memory footprint
+        x = sequence.pad_sequences(x, maxlen=self.input_shape[0], dtype='int16')
         return x
 
     # Model structure and generation
@@ -582,7 +632,7 @@ class Esc50(Dataset):
         self.num_classes = 50
         self.input_shape = (40, 431, 1)
 
-        (x_train, y_train), (x_test, y_test) = self.load_data()
+        (x_train, y_train), (x_test, y_test) = self.load_cached_data()
 
         super(Esc50, self).__init__(dataset_name='esc50',
                                     num_classes=self.num_classes,
@@ -603,23 +653,49 @@ class Esc50(Dataset):
 
     def preprocess_dataset_inputs(self, x):
         """
-        Compute the Mel-Frequency Cepstral Coefficients
-        :param x: iterator. Yield tuples, of audio and rate.
+        Compute the Mel-Frequency Cepstral Coefficients. Audio files are processed in parallel by chunks,
+        each worker handling its chunk end-to-end.
+        :param x: list of paths to the audio files.
         :return: Array of mfcc images.
         """
 
+        chunks = [x[i:i + 16] for i in range(0, len(x), 16)]
+        features_list = Parallel(n_jobs=-1)(delayed(self._compute_mfccs)(chunk) for chunk in chunks)
+
+        # Write each mfcc image directly in its slot of the output array
+        features = np.empty((len(x),) + self.input_shape, dtype=np.float32)
+        for i, mfccs in enumerate(chain.from_iterable(features_list)):
+            features[i, ..., 0] = mfccs
+        return features
+
+    @staticmethod
+    def _compute_mfccs(file_paths):
+        """
+        Decode the next audio file in a background thread while computing the MFCC of the current one,
+        so that disk reads overlap with the FFTs.
+        This is equivalent to librosa.feature.mfcc(y=audio, sr=rate, n_mfcc=40), except that the mel filterbank
+        is built once per sampling rate for the whole chunk, instead of once per audio file.
+        """
         features_list = []
-        for audio, rate in x:
-            mfccs = mfcc(y=audio, sr=rate, n_mfcc=40)
-            # mfccs_scaled = np.mean(mfccs.T, axis=0)
-            features_list.append(mfccs)
-        features = np.array(features_list)
-        return features.reshape(((features.shape[0],) + self.input_shape))
+        mel_bases = {}
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_audio = executor.submit(wav_load, file_paths[0], sr=None)
+            for i in range(len(file_paths)):
+                audio, rate = next_audio.result()
+                if i + 1 < len(file_paths):
+                    next_audio = executor.submit(wav_load, file_paths[i + 1], sr=None)
+                if rate not in mel_bases:
+                    mel_bases[rate] = mel(sr=rate, n_fft=2048)
+                mel_spectrogram = mel_bases[rate].dot(np.abs(stft(audio, n_fft=2048, hop_length=512)) ** 2)
+                mfccs = mfcc(S=power_to_db(mel_spectrogram), n_mfcc=40)
+                # mfccs_scaled = np.mean(mfccs.T, axis=0)
+                features_list.append(mfccs)
+        return features_list
 
     # download train and test sets
     def load_data(self):
         """
-        load the dataset. Note that the x are iterators which need to be preprocess
+        load the dataset. Note that the x are lists of audio file paths which need to be preprocess
         :return: (x_train, y_train), (x_test, y_test)
         """
         path = Path(__file__).resolve().parents[0]
@@ -635,10 +711,8 @@ class Esc50(Dataset):
         train, test = self.train_test_split_global(esc50_df)
         y_train = train.target.to_numpy()
         y_test = test.target.to_numpy()
-        x_train = (wav_load((folder / 'audio' / file_name).resolve(), sr=None)
-                   for file_name in train.filename.to_list())
-        x_test = (wav_load((folder / 'audio' / file_name).resolve(), sr=None)
-                  for file_name in test.filename.to_list())
+        x_train = [str((folder / 'audio' / file_name).resolve()) for file_name in train.filename.to_list()]
+        x_test = [str((folder / 'audio' / file_name).resolve()) for file_name in test.filename.to_list()]
 
         # Pre-process inputs
         logger.info('Preprocessing the raw audios')
@@ -664,7 +738,10 @@ class Esc50(Dataset):
         attempts = 0
         while True:
             try:
-                urlretrieve('https://github.com/karoldvl/ESC-50/archive/master.zip', f'{path}/ESC-50.zip')
+                # Stream the archive to disk by chunks of 1 MiB
+                with urlopen('https://github.com/karoldvl/ESC-50/archive/master.zip') as response, \
+                        open(f'{path}/ESC-50.zip', 'wb') as zip_file:
+                    shutil.copyfileobj(response, zip_file, length=2 ** 20)
                 break
             except (HTTPError, URLError) as e:
                 if hasattr(e, 'code'):
@@ -3,11 +3,13 @@
 This enables to parameterize a desired scenario to mock a multi-partner ML project.
 """
 
+import copy
 import datetime
-import operator
+import functools
 import os
 import random
 import uuid
+from math import fsum
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -24,6 +26,41 @@ from .multi_partner_learning import MULTI_PARTNER_LEARNING_APPROACHES
 from .partner import Partner
 
 
+@functools.lru_cache(maxsize=1)
+def load_dataset(dataset_name, dataset_proportion=1):
+    """Return the Dataset object selected, truncated to the proportion given.
+    The last Dataset object returned is kept in memory, as consecutive scenarios generally use the same dataset
+    and dataset proportion"""
+
+    if dataset_proportion < 1:
+        dataset = copy.copy(instantiate_dataset(dataset_name))
+        dataset.shorten_dataset_proportion(dataset_proportion)
+        return dataset
+    return instantiate_dataset(dataset_name)
+
+
+@functools.lru_cache(maxsize=1)
+def instantiate_dataset(dataset_name):
+    """Reference the module corresponding to the dataset selected and initialize the Dataset object.
+    The last Dataset object loaded is kept in memory, so that it is not reloaded for another dataset proportion"""
+
+    if dataset_name == constants.MNIST:  # default
+        return dataset_module.Mnist()
+    elif dataset_name == constants.CIFAR10:
+        return dataset_module.Cifar10()
+    elif dataset_name == constants.TITANIC:
+        return dataset_module.Titanic()
+    elif dataset_name == constants.ESC50:
+        return dataset_module.Esc50()
+    elif dataset_name == constants.IMDB:
+        return dataset_module.Imdb()
+    else:
+        raise Exception(
+            f"Dataset named '{dataset_name}' is not supported (yet). You can construct your own "
+            f"dataset object, or even add it by contributing to the project !"
+        )
+
+
 class Scenario:
     def __init__(
             self,
@@ -127,30 +164,6 @@ class Scenario:
                 f"Unrecognised parameters {unrecognised_parameters}, check your configuration"
             )
 
-        # Get and verify which dataset is configured
-        if isinstance(dataset, dataset_module.Dataset):
-            self.dataset = dataset
-        else:
-            # Reference the module corresponding to the dataset selected and initialize the Dataset object
-            if dataset_name == constants.MNIST:  # default
-                self.dataset = dataset_module.Mnist()
-            elif dataset_name == constants.CIFAR10:
-                self.dataset = dataset_module.Cifar10()
-            elif dataset_name == constants.TITANIC:
-                self.dataset = dataset_module.Titanic()
-            elif dataset_name == constants.ESC50:
-                self.dataset = dataset_module.Esc50()
-            elif dataset_name == constants.IMDB:
-                self.dataset = dataset_module.Imdb()
-            else:
-                raise Exception(
-                    f"Dataset named '{dataset_name}' is not supported (yet). You can construct your own "
-                    f"dataset object, or even add it by contributing to the project !"
-                )
-            logger.debug(f"Dataset selected: {dataset_name}")
-
-        # The train set is split into a train set and a validation set (used in particular for early stopping)
-
         # The proportion of the dataset the computation will used
 
         self.dataset_proportion = dataset_proportion
@@ -161,9 +174,20 @@ class Scenario:
                 self.dataset_proportion <= 1
         ), "Error in the config file, dataset_proportion should be <= 1"
 
-        if self.dataset_proportion < 1:
+        # Get and verify which dataset is configured
+        if isinstance(dataset, dataset_module.Dataset):
+            self.dataset = dataset
             self.dataset.shorten_dataset_proportion(self.dataset_proportion)
         else:
+            # The Dataset object is shared with the previous scenario if it used the same dataset and dataset
+            # proportion. It is shallow copied, so that the scenario can reassign its arrays (quick demo) without
+            # side effect
+            self.dataset = copy.copy(load_dataset(dataset_name, self.dataset_proportion))
+            logger.debug(f"Dataset selected: {dataset_name}")
+
+        # The train set is split into a train set and a validation set (used in particular for early stopping)
+
+        if self.dataset_proportion == 1:
             logger.debug(
                 f"Computation use the full dataset for scenario #{scenario_id}"
             )
@@ -220,8 +244,7 @@ class Scenario:
         except KeyError:
             text_error = f"Multi-partner learning approach '{multi_partner_learning_approach}' is not a valid "
             text_error += "approach. List of supported approach : "
-            for key in MULTI_PARTNER_LEARNING_APPROACHES.keys():
-                text_error += f"{key}, "
+            text_error += ", ".join(MULTI_PARTNER_LEARNING_APPROACHES.keys())
             raise KeyError(text_error)
 
         # Define how federated learning aggregation steps are weighted. Toggle between 'uniform' and 'data_volume'
@@ -326,28 +349,15 @@ class Scenario:
 
         now = datetime.datetime.now()
         now_str = now.strftime("%Y-%m-%d_%Hh%M")
-        self.scenario_name = (
-                "scenario_"
-                + str(self.scenario_id)
-                + "_"
-                + "repeat"
-                + "_"
-                + str(self.n_repeat)
-                + "_"
-                + now_str
-                + "_"
-                + uuid.uuid4().hex[
-                  :3
-                  ]  # This is to be sure 2 distinct scenarios do no have the same name
-        )
+        # The uuid is to be sure 2 distinct scenarios do no have the same name
+        self.scenario_name = f"scenario_{self.scenario_id}_repeat_{self.n_repeat}_{now_str}_{uuid.uuid4().hex[:3]}"
 
-        self.short_scenario_name = (
-                str(self.partners_count) + " " + str(self.amounts_per_partner)
-        )
+        self.short_scenario_name = f"{self.partners_count} {self.amounts_per_partner}"
 
-        self.save_folder = experiment_path / self.scenario_name
-        if not is_dry_run:
-            self.save_folder.mkdir(parents=True, exist_ok=True)
+        # The save folder is created on the first access to the save_folder property (by the multi-partner learning
+        # or the data distribution plot), so that validating a scenario with a dry run doesn't create it
+        self._save_folder = experiment_path / self.scenario_name
+        self._is_save_folder_created = False
 
         # ------------------------------------------------
         # Print the description of the scenario configured
@@ -377,6 +387,13 @@ class Scenario:
                 f"   {len(self.dataset.x_test)} test data with {len(self.dataset.y_test)} labels"
             )
 
+    @property
+    def save_folder(self):
+        if not self._is_save_folder_created:
+            self._save_folder.mkdir(parents=True, exist_ok=True)
+            self._is_save_folder_created = True
+        return self._save_folder
+
     def append_contributivity(self, contributivity):
 
         self.contributivity_list.append(contributivity)
@@ -393,6 +410,7 @@ class Scenario:
         """Advanced split: Populates the partners with their train and test data (not pre-processed)"""
 
         y_train = LabelEncoder().fit_transform([str(y) for y in self.dataset.y_train])
+        nb_train_samples = len(y_train)
         partners_list = self.partners_list
         amounts_per_partner = self.amounts_per_partner
         advanced_split_description = self.samples_split_description
@@ -407,17 +425,17 @@ class Scenario:
         partners_with_specific_clusters = [
             p for p in partners_list if p.cluster_split_option == "specific"
         ]
-        partners_with_shared_clusters.sort(
-            key=operator.attrgetter("cluster_count"), reverse=True
-        )
-        partners_with_specific_clusters.sort(
-            key=operator.attrgetter("cluster_count"), reverse=True
-        )
+        partners_with_shared_clusters.sort(key=lambda p: -p.cluster_count)
+        partners_with_specific_clusters.sort(key=lambda p: -p.cluster_count)
 
         # Compose the list of different labels in the dataset
-        labels = list(set(y_train))
+        # A local generator is used for the split, but the random module is still seeded, as the partial corruption
+        # of the partners' labels (see Partner.corrupt_labels) draws its samples with random.sample
         random.seed(42)
-        random.shuffle(labels)
+        rng = np.random.default_rng(42)
+        labels = np.unique(y_train)
+        rng.shuffle(labels)
+        labels = labels.tolist()
 
         # Check coherence of the split option:
         nb_diff_labels = len(labels)
@@ -440,12 +458,12 @@ class Scenario:
             less than 10 labels"
 
         # Stratify the dataset into clusters per labels
-        x_train_for_cluster, y_train_for_cluster, nb_samples_per_cluster = {}, {}, {}
-        for label in labels:
-            idx_in_full_trainset = np.where(y_train == label)
-            x_train_for_cluster[label] = self.dataset.x_train[idx_in_full_trainset]
-            y_train_for_cluster[label] = self.dataset.y_train[idx_in_full_trainset]
-            nb_samples_per_cluster[label] = len(y_train_for_cluster[label])
+        # The sample indices are sorted once by label (keeping their order within a label), so that the indices of
+        # each cluster are a contiguous slice of the sorted indices
+        order = np.argsort(y_train, kind="stable")
+        bounds = np.searchsorted(y_train[order], np.arange(nb_diff_labels + 1))
+        # As labels are encoded from 0 to nb_diff_labels - 1, the nb of samples per cluster is indexed by label
+        nb_samples_per_cluster = np.diff(bounds)
 
         # For each partner compose the list of clusters from which they will draw data samples
         index = 0
@@ -455,7 +473,8 @@ class Scenario:
 
         shared_clusters = labels[index: index + shared_clusters_count]
         for p in partners_with_shared_clusters:
-            p.clusters_list = random.sample(shared_clusters, k=p.cluster_count)
+            p.clusters_list = [shared_clusters[i]
+                               for i in rng.choice(len(shared_clusters), size=p.cluster_count, replace=False)]
 
         # We need to enforce the relative data amounts configured.
         # It might not be possible to distribute all data samples, depending on...
@@ -466,10 +485,8 @@ class Scenario:
         # ... compare the nb of available samples vs. the nb of samples initially configured
         resize_factor_specific = 1
         for p in partners_with_specific_clusters:
-            nb_available_samples = sum(
-                [nb_samples_per_cluster[cl] for cl in p.clusters_list]
-            )
-            nb_samples_requested = int(amounts_per_partner[p.id] * len(y_train))
+            nb_available_samples = int(nb_samples_per_cluster[p.clusters_list].sum())
+            nb_samples_requested = int(amounts_per_partner[p.id] * nb_train_samples)
             ratio = nb_available_samples / nb_samples_requested
             resize_factor_specific = min(resize_factor_specific, ratio)
 
@@ -478,20 +495,19 @@ class Scenario:
         # ... then sum per cluster how many samples are needed.
         # Then, find if a cluster is requested more samples than it has, and if yes by which factor
         resize_factor_shared = 1
-        nb_samples_needed_per_cluster = dict.fromkeys(shared_clusters, 0)
+        nb_samples_needed_per_cluster = np.zeros(nb_diff_labels, dtype=int)
         for p in partners_with_shared_clusters:
             initial_amount_resized = int(
-                amounts_per_partner[p.id] * len(y_train) * resize_factor_specific
+                amounts_per_partner[p.id] * nb_train_samples * resize_factor_specific
             )
             initial_amount_resized_per_cluster = int(
                 initial_amount_resized / p.cluster_count
             )
-            for cl in p.clusters_list:
-                nb_samples_needed_per_cluster[cl] += initial_amount_resized_per_cluster
-        for cl in nb_samples_needed_per_cluster:
+            nb_samples_needed_per_cluster[p.clusters_list] += initial_amount_resized_per_cluster
+        if shared_clusters:
             resize_factor_shared = min(
                 resize_factor_shared,
-                nb_samples_per_cluster[cl] / nb_samples_needed_per_cluster[cl],
+                (nb_samples_per_cluster[shared_clusters] / nb_samples_needed_per_cluster[shared_clusters]).min(),
             )
 
         # Compute the final resize factor
@@ -500,7 +516,7 @@ class Scenario:
         # Size correctly each partner's subset. For each partner:
         for p in partners_list:
             p.final_nb_samples = int(
-                amounts_per_partner[p.id] * len(y_train) * final_resize_factor
+                amounts_per_partner[p.id] * nb_train_samples * final_resize_factor
             )
             p.final_nb_samples_p_cluster = int(p.final_nb_samples / p.cluster_count)
         self.nb_samples_used = sum([p.final_nb_samples for p in partners_list])
@@ -512,29 +528,21 @@ class Scenario:
         shared_clusters_index = dict.fromkeys(shared_clusters, 0)
         for p in partners_list:
 
-            list_arrays_x, list_arrays_y = [], []
-
-            if p in partners_with_shared_clusters:
-                for cl in p.clusters_list:
-                    idx = shared_clusters_index[cl]
-                    list_arrays_x.append(
-                        x_train_for_cluster[cl][idx: idx + p.final_nb_samples_p_cluster]
-                    )
-                    list_arrays_y.append(
-                        y_train_for_cluster[cl][idx: idx + p.final_nb_samples_p_cluster]
-                    )
+            # Compose the indices drawn from each cluster: partners with shared clusters draw after the samples
+            # already given to the previous partners, partners with specific clusters draw from the start
+            clusters_indices = []
+            for cl in p.clusters_list:
+                if p in partners_with_shared_clusters:
+                    idx = bounds[cl] + shared_clusters_index[cl]
                     shared_clusters_index[cl] += p.final_nb_samples_p_cluster
-            elif p in partners_with_specific_clusters:
-                for cl in p.clusters_list:
-                    list_arrays_x.append(
-                        x_train_for_cluster[cl][: p.final_nb_samples_p_cluster]
-                    )
-                    list_arrays_y.append(
-                        y_train_for_cluster[cl][: p.final_nb_samples_p_cluster]
-                    )
+                else:
+                    idx = bounds[cl]
+                clusters_indices.append(order[idx: min(idx + p.final_nb_samples_p_cluster, bounds[cl + 1])])
 
-            p.x_train = np.concatenate(list_arrays_x)
-            p.y_train = np.concatenate(list_arrays_y)
+            # Gather them from the dataset in a single pass
+            partner_indices = np.concatenate(clusters_indices)
+            p.x_train = self.dataset.x_train[partner_indices]
+            p.y_train = self.dataset.y_train[partner_indices]
 
             # Create local validation and test datasets from the partner train data
             p.x_train, p.x_val, p.y_train, p.y_val = train_test_split(
@@ -574,6 +582,7 @@ class Scenario:
         # Fetch parameters of scenario
 
         y_train = LabelEncoder().fit_transform([str(y) for y in self.dataset.y_train])
+        nb_train_samples = len(y_train)
 
         # Configure the desired splitting scenario - Datasets sizes
         # Should the partners receive an equivalent amount of samples each...
@@ -585,22 +594,14 @@ class Scenario:
         ), "Error: in the provided config file, \
             amounts_per_partner list should have a size equals to partners_count"
         assert (
-                np.sum(self.amounts_per_partner) == 1
+                abs(fsum(self.amounts_per_partner) - 1) < 1e-9
         ), "Error: in the provided config file, \
             amounts_per_partner argument: the sum of the proportions you provided isn't equal to 1"
 
         # Then we parameterize this via the splitting_indices to be passed to np.split
         # This is to transform the percentages from the scenario configuration into indices where to split the data
-        if self.partners_count == 1:
-            splitting_indices_train = 1
-        else:
-            splitting_indices = np.empty((self.partners_count - 1,))
-            splitting_indices[0] = self.amounts_per_partner[0]
-            for i in range(self.partners_count - 2):
-                splitting_indices[i + 1] = (
-                        splitting_indices[i] + self.amounts_per_partner[i + 1]
-                )
-            splitting_indices_train = (splitting_indices * len(y_train)).astype(int)
+        splitting_indices = np.cumsum(self.amounts_per_partner[:-1])
+        splitting_indices_train = (splitting_indices * nb_train_samples).astype(int)
 
         # Configure the desired data distribution scenario
         # In the 'stratified' scenario we sort by labels
@@ -610,9 +611,8 @@ class Scenario:
 
         # In the 'random' scenario we shuffle randomly the indexes
         elif self.samples_split_description == "random":
-            train_idx = np.arange(len(y_train))
             np.random.seed(42)
-            np.random.shuffle(train_idx)
+            train_idx = np.random.permutation(nb_train_samples)
 
         # If neither 'stratified' nor 'random', we raise an exception
         else:
@@ -623,18 +623,18 @@ class Scenario:
             )
 
         # Do the partitioning among partners according to desired scenarios
-        # Split data between partners
-        train_idx_idx_list = np.split(train_idx, splitting_indices_train)
+        # Split data between partners: the samples are gathered once in the desired order, then split in views
+        x_train_list = np.split(self.dataset.x_train[train_idx], splitting_indices_train)
+        y_train_list = np.split(self.dataset.y_train[train_idx], splitting_indices_train)
+        labels_list = np.split(y_train[train_idx], splitting_indices_train)
 
         # Populate partners
-        partner_idx = 0
-        for train_idx in train_idx_idx_list:
-            p = self.partners_list[partner_idx]
-
-            # Finalize selection of train data
+        for p, partner_x_train, partner_y_train, partner_labels in zip(
+                self.partners_list, x_train_list, y_train_list, labels_list
+        ):
             # Populate the partner's train dataset
-            p.x_train = self.dataset.x_train[train_idx, :]
-            p.y_train = self.dataset.y_train[train_idx]
+            p.x_train = partner_x_train
+            p.y_train = partner_y_train
 
             # Create local validation and test datasets from the partner train data
             (
@@ -649,14 +649,11 @@ class Scenario:
 
             # Update other attributes from partner
             p.final_nb_samples = len(p.x_train)
-            p.clusters_list = list(set(y_train[train_idx]))
-
-            # Move on to the next partner
-            partner_idx += 1
+            p.clusters_list = np.unique(partner_labels).tolist()
 
         # Check coherence of number of mini-batches versus smaller partner
         assert self.minibatch_count <= (
-                min(self.amounts_per_partner) * len(y_train)
+                min(self.amounts_per_partner) * nb_train_samples
         ), "Error: in the provided config \
             file and dataset, a partner doesn't have enough data samples to create the minibatches"
 
@@ -682,17 +679,14 @@ class Scenario:
 
     def plot_data_distribution(self):
         lb = LabelEncoder().fit([str(y) for y in self.dataset.y_train])
-        for i, partner in enumerate(self.partners_list):
-
-            plt.subplot(self.partners_count, 1, i + 1)  # TODO share y axis
-            data_count = np.bincount(lb.transform([str(y) for y in partner.y_train]))
+        _, axes = plt.subplots(self.partners_count, 1, sharey=True, squeeze=False)
+        for ax, partner in zip(axes[:, 0], self.partners_list):
 
-            # Fill with 0
-            while len(data_count) < self.dataset.num_classes:
-                data_count = np.append(data_count, 0)
+            data_count = np.bincount(lb.transform([str(y) for y in partner.y_train]),
+                                     minlength=self.dataset.num_classes)
 
-            plt.bar(np.arange(0, self.dataset.num_classes), data_count)
-            plt.ylabel("partner " + str(partner.id))
+            ax.bar(np.arange(0, self.dataset.num_classes), data_count)
+            ax.set_ylabel("partner " + str(partner.id))
 
         plt.suptitle("Data distribution")
         plt.xlabel("Digits")
@@ -787,60 +781,59 @@ class Scenario:
 
     def to_dataframe(self):
 
-        df = pd.DataFrame()
-        dict_results = {}
-
-        # Scenario definition parameters
-        dict_results["scenario_name"] = self.scenario_name
-        dict_results["short_scenario_name"] = self.short_scenario_name
-        dict_results["dataset_name"] = self.dataset.name
-        dict_results["train_data_samples_count"] = len(self.dataset.x_train)
-        dict_results["test_data_samples_count"] = len(self.dataset.x_test)
-        dict_results["partners_count"] = self.partners_count
-        dict_results["dataset_fraction_per_partner"] = self.amounts_per_partner
-        dict_results["samples_split_description"] = self.samples_split_description
-        dict_results["nb_samples_used"] = self.nb_samples_used
-        dict_results["final_relative_nb_samples"] = self.final_relative_nb_samples
-
-        # Multi-partner learning approach parameters
-        dict_results["multi_partner_learning_approach"] = self.multi_partner_learning_approach
-        dict_results["aggregation"] = self.aggregation
-        dict_results["epoch_count"] = self.epoch_count
-        dict_results["minibatch_count"] = self.minibatch_count
-        dict_results[
-            "gradient_updates_per_pass_count"
-        ] = self.gradient_updates_per_pass_count
-        dict_results["is_early_stopping"] = self.is_early_stopping
-        dict_results["mpl_test_score"] = self.mpl.history.score
-        dict_results["mpl_nb_epochs_done"] = self.mpl.history.nb_epochs_done
-        dict_results["learning_computation_time_sec"] = self.mpl.learning_computation_time
+        # The rows are collected in a list and the DataFrame is built once at the end, as appending to a DataFrame
+        # copies it entirely
+        rows = []
+
+        # Scenario definition and multi-partner learning approach parameters, shared by all rows
+        scenario_base = {
+            "scenario_name": self.scenario_name,
+            "short_scenario_name": self.short_scenario_name,
+            "dataset_name": self.dataset.name,
+            "train_data_samples_count": len(self.dataset.x_train),
+            "test_data_samples_count": len(self.dataset.x_test),
+            "partners_count": self.partners_count,
+            "dataset_fraction_per_partner": self.amounts_per_partner,
+            "samples_split_description": self.samples_split_description,
+            "nb_samples_used": self.nb_samples_used,
+            "final_relative_nb_samples": self.final_relative_nb_samples,
+            "multi_partner_learning_approach": self.multi_partner_learning_approach,
+            "aggregation": self.aggregation,
+            "epoch_count": self.epoch_count,
+            "minibatch_count": self.minibatch_count,
+            "gradient_updates_per_pass_count": self.gradient_updates_per_pass_count,
+            "is_early_stopping": self.is_early_stopping,
+            "mpl_test_score": self.mpl.history.score,
+            "mpl_nb_epochs_done": self.mpl.history.nb_epochs_done,
+            "learning_computation_time_sec": self.mpl.learning_computation_time,
+        }
 
         if not self.contributivity_list:
-            df = df.append(dict_results, ignore_index=True)
+            rows.append(scenario_base)
 
         for contrib in self.contributivity_list:
 
-            # Contributivity data
-            dict_results["contributivity_method"] = contrib.name
-            dict_results["contributivity_scores"] = contrib.contributivity_scores
-            dict_results["contributivity_stds"] = contrib.scores_std
-            dict_results["computation_time_sec"] = contrib.computation_time_sec
-            dict_results[
-                "first_characteristic_calls_count"
-            ] = contrib.first_charac_fct_calls_count
+            # Contributivity data, shared by the rows of all partners
+            contrib_base = {
+                **scenario_base,
+                "contributivity_method": contrib.name,
+                "contributivity_scores": contrib.contributivity_scores,
+                "contributivity_stds": contrib.scores_std,
+                "computation_time_sec": contrib.computation_time_sec,
+                "first_characteristic_calls_count": contrib.first_charac_fct_calls_count,
+            }
 
             for i in range(self.partners_count):
                 # Partner-specific data
-                dict_results["partner_id"] = i
-                dict_results["dataset_fraction_of_partner"] = self.amounts_per_partner[
-                    i
-                ]
-                dict_results["contributivity_score"] = contrib.contributivity_scores[i]
-                dict_results["contributivity_std"] = contrib.scores_std[i]
-
-                df = df.append(dict_results, ignore_index=True)
-
-        return df
+                rows.append({
+                    **contrib_base,
+                    "partner_id": i,
+                    "dataset_fraction_of_partner": self.amounts_per_partner[i],
+                    "contributivity_score": contrib.contributivity_scores[i],
+                    "contributivity_std": contrib.scores_std[i],
+                })
+
+        return pd.DataFrame.from_records(rows)
 
     def run(self):
         # -----------------------
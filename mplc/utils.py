@@ -142,6 +142,9 @@ def init_gpu_config():
             gpus[0],
             [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=constants.GPU_MEMORY_LIMIT_MB)]
         )
+        if constants.IS_XLA_JIT_ENABLED:
+            tf.config.optimizer.set_jit(True)
+            logger.info("XLA JIT compilation enabled")
     else:
         logger.info("No GPU found")
 
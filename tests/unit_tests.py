@@ -47,6 +47,7 @@ import numpy as np
 import pytest
 import yaml
 
+import main
 from mplc import constants, utils
 from mplc.contributivity import Contributivity
 from mplc.dataset import Mnist, Cifar10, Imdb, Titanic, Esc50
@@ -190,6 +191,20 @@ class Test_Scenario:
         with pytest.raises(Exception):
             scenario.instantiate_scenario_partners()
 
+    def test_split_data_amounts_rounding(self):
+        """amounts_per_partner which sum to 1 only up to floating point rounding are accepted"""
+        assert np.sum([0.7, 0.2, 0.1]) != 1
+        scenario = Scenario(3, [0.7, 0.2, 0.1], dataset=Titanic(), is_dry_run=True)
+        scenario.instantiate_scenario_partners()
+        scenario.split_data(is_logging_enabled=False)
+        assert all(len(p.x_train) > 0 for p in scenario.partners_list)
+
+    def test_split_data_amounts_not_summing_to_one(self):
+        scenario = Scenario(2, [0.5, 0.4], dataset=Titanic(), is_dry_run=True)
+        scenario.instantiate_scenario_partners()
+        with pytest.raises(AssertionError, match="isn't equal to 1"):
+            scenario.split_data(is_logging_enabled=False)
+
 
 class Test_Partner:
     def test_corrupt_labels(self, create_Partner):
@@ -256,9 +271,22 @@ class Test_Dataset:
         data = create_all_datasets
         assert len(data.x_val) < len(data.x_train)
         assert len(data.x_test) < len(data.x_train)
-        with pytest.raises(Exception):
+        with pytest.raises(Exception, match="x_val and y_val should be of NoneType"):
             data.train_val_split_global()
 
+    def test_titanic_val_split(self):
+        """Titanic builds its validation set itself, as a view on the tail of the train set"""
+        data = Titanic()
+        nb_samples = len(data.x_train) + len(data.x_val)
+        assert len(data.x_val) == len(data.y_val) == int(np.ceil(0.1 * nb_samples))
+        assert not np.shares_memory(data.x_train, data.x_val)
+        assert not np.shares_memory(data.y_train, data.y_val)
+        # No copy is made: the train and validation sets are views on the same array, the latter being its tail
+        for train, val in ((data.x_train, data.x_val), (data.y_train, data.y_val)):
+            assert val.base is not None and val.base is train.base
+            assert len(val.base) == nb_samples
+            assert np.array_equal(val, val.base[-len(val):])
+
     def test_local_split(self, create_all_datasets):
         data = create_all_datasets
         x_train, x_val, y_train, y_val = data.train_val_split_local(data.x_train, data.y_train)
@@ -292,6 +320,37 @@ class Test_Dataset:
         assert callable(model.get_weights), ' .get_weights() method is required for model'
         assert callable(model.set_weights), ".set_weights() method is required for model"
 
+    def test_titanic_weights_round_trip(self, tmp_path):
+        """Titanic's LogisticRegression switches .h5 paths to .joblib, both when saving and loading its weights"""
+        data = Titanic()
+        model = data.generate_new_model()
+        model.fit(data.x_train, data.y_train, batch_size=None, validation_data=(data.x_val, data.y_val))
+        model.save_weights(str(tmp_path / 'w.h5'))
+        assert (tmp_path / 'w.joblib').exists()
+
+        new_model = data.generate_new_model()
+        new_model.load_weights(str(tmp_path / 'w.h5'))
+        assert np.array_equal(new_model.coef_, model.coef_)
+        assert np.array_equal(new_model.intercept_, model.intercept_)
+
+
+#####
+#
+# Test main script
+#
+######
+
+class Test_Main:
+    def test_validate_scenario_list(self, tmp_path):
+        """The validation of the scenarios is a dry run, which shouldn't write anything in the experiment folder"""
+        scenario_params_list = [
+            {"dataset_name": "titanic", "partners_count": 2, "amounts_per_partner": [0.4, 0.6]},
+            {"dataset_name": "titanic", "partners_count": 2, "amounts_per_partner": [0.4, 0.6],
+             "samples_split_option": ["basic", "stratified"]},
+        ]
+        main.validate_scenario_list(scenario_params_list, tmp_path)
+        assert not any(tmp_path.iterdir())
+
 
 #####
 #